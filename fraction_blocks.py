@@ -5,18 +5,137 @@ python script for generating 3D printable fraction blocks
 """
 
 import dataclasses
+import hashlib
+import json
+import os
+import shutil
+import struct
+import subprocess
 from dataclasses import dataclass
+from functools import cache
+from pathlib import Path
 
-from solid import scad_render_to_file
+from solid import scad_render
+from solid.solidpython import py2openscad, sp_code_in_scad_comment
 from solid.objects import (
     union, offset, difference, square, rotate_extrude, text, translate, rotate,
-    linear_extrude, scale, cylinder
+    linear_extrude, scale, cylinder, import_
 )
 
 import fire
 
 
-@dataclass(kw_only=True)
+class ScadVariable:  # pylint: disable=too-few-public-methods
+    """Refers to an OpenSCAD variable by name in SolidPython arguments.
+
+    SolidPython writes any argument it doesn't otherwise recognize with
+    str(), so this renders as the bare variable name.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def __str__(self) -> str:
+        return self.name
+
+
+@cache
+def openscad_executable() -> str:
+    """Find the absolute path of the OpenSCAD binary.
+
+    Launching a program by absolute path with close_fds=False lets
+    subprocess start it with posix_spawn rather than fork and exec, which
+    stays cheap however much memory this process has built up.
+    """
+    return shutil.which('openscad') or 'openscad'
+
+
+@cache
+def openscad_flags() -> list[str]:
+    """Ask the installed OpenSCAD which fast rendering options it supports.
+
+    The Manifold backend needs OpenSCAD 2023.x or newer. Older releases
+    silently fall back to CGAL, and flags a binary doesn't know about
+    are never passed to it.
+    """
+    try:
+        probe = subprocess.run(
+            [openscad_executable(), '--help'],
+            capture_output=True,
+            text=True,
+            check=False,
+            close_fds=False
+        )
+    except FileNotFoundError:
+        return []
+    usage = probe.stdout + probe.stderr
+
+    # Recent releases promote manifold from an experimental feature to
+    # a selectable backend.
+    if '--backend' in usage:
+        flags = ['--backend=manifold']
+    else:
+        flags = [
+            f'--enable={feature}' for feature in ('manifold', 'fast-csg')
+            if feature in usage
+        ]
+    if 'lazy-union' in usage:
+        flags.append('--enable=lazy-union')
+    return flags
+
+
+def openscad(
+    scad: str,
+    output: str,
+    export_format: str,
+    flags: list[str],
+    env: dict[str, str] | None = None
+) -> None:
+    """Render OpenSCAD code to an output file in the given format"""
+    # OpenSCAD reads its input from stdin when the input file is '-',
+    # so the generated code never has to touch the disk.
+    subprocess.run(
+        [
+            openscad_executable(), *flags, '-o', output, '--export-format',
+            export_format, '--quiet', '-'
+        ],
+        input=scad.encode(),
+        check=True,
+        close_fds=False,
+        stdout=subprocess.DEVNULL,
+        env=env
+    )
+
+
+def write_binary_stl(filename: str, vertices, triangles) -> None:
+    """Write a triangle mesh held in numpy arrays to a binary STL file"""
+    import numpy  # pylint: disable=import-outside-toplevel
+
+    corners = vertices[triangles]
+    normals = numpy.cross(
+        corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]
+    )
+    lengths = numpy.linalg.norm(normals, axis=1, keepdims=True)
+    normals = numpy.divide(
+        normals, lengths, out=numpy.zeros_like(normals), where=lengths > 0
+    )
+
+    records = numpy.zeros(
+        len(triangles),
+        dtype=[
+            ('normal', '<f4', (3,)), ('corners', '<f4', (3, 3)),
+            ('attribute', '<u2')
+        ]
+    )
+    records['normal'] = normals
+    records['corners'] = corners
+    with open(filename, 'wb') as stl:
+        stl.write(bytes(80))
+        stl.write(struct.pack('<I', len(records)))
+        stl.write(records.tobytes())
+
+
+@dataclass(kw_only=True, slots=True)
 class FractionBlocks:
     """
     python script for generating 3D printable fraction blocks
@@ -55,6 +174,8 @@ class FractionBlocks:
         label_font_size (int): approximate height of label font (default = 13 mm)
         fillet (int): radius of fillets (default = 2 mm)
         segments (int): larger values make circles more circular (default = 200)
+        include_code (bool): embed this script in the .scad output (default = True)
+        profile_file (str): pre-rendered slice profile to import (default = '')
 
     """
 
@@ -102,49 +223,117 @@ class FractionBlocks:
     fillet: int = 2
 
     # Wherever we use openscad to render a curve, this parameter
-    # controls the smoothness of the curve.
+    # controls the smoothness of the curve. It's the number of segments
+    # in a full circle. OpenSCAD already scales it down for a slice's
+    # rotate_extrude to cover just the slice's angle, so a 1/16 slice
+    # gets 13 segments, not 200. Lower values render faster but look
+    # more faceted.
     segments: int = 200
 
+    # SolidPython can append the source of this script to the .scad
+    # output as a comment. That's handy when a single file is passed
+    # around, but it's dead weight when rendering many blocks in a batch.
+    include_code: bool = True
+
+    # The cross section of a pie slice only depends on its radius,
+    # height and fillet, so a batch of slices can share one copy of it
+    # rendered to a .dxf file instead of having OpenSCAD offset the same
+    # square for every slice. When empty, the profile is built inline.
+    profile_file: str = ''
+
     _angle: float = dataclasses.field(init=False)
     _scad_file: str = dataclasses.field(init=False)
     _stl_file: str = dataclasses.field(init=False)
+    _numerator_text: text = dataclasses.field(init=False)
+    _denominator_text: text = dataclasses.field(init=False)
+    _vinculum_text: text = dataclasses.field(init=False)
+    _numerator_y: float = dataclasses.field(init=False)
+    _vinculum_y: float = dataclasses.field(init=False)
+    _denominator_y: float = dataclasses.field(init=False)
+    _label_height: float = dataclasses.field(init=False)
+    _profile_width: float = dataclasses.field(init=False)
+    _profile_height: float = dataclasses.field(init=False)
+    _pan_height: float = dataclasses.field(init=False)
 
     def __post_init__(self) -> None:
         self._angle = 360 * self.numerator / self.denominator
 
+        # Work out the layout once instead of on every assembly
+        divide = self.slice_radius / 2
+        self._numerator_y = divide / 2 + self.label_position
+        self._vinculum_y = divide - .05 * self.slice_radius + self.label_position
+        self._denominator_y = divide + divide / 2 + self.label_position
+        self._label_height = 0.2 * self.slice_height
+        self._profile_width = self.slice_radius - 2 * self.fillet
+        self._profile_height = self.slice_height - 2 * self.fillet
+        self._pan_height = self.pan_floor_height + self.slice_height * 0.8
+
+        # The label text never changes for a given block, so build its
+        # nodes once and reuse them every time the label is assembled.
+        self._numerator_text = self._assemble_text(str(self.numerator))
+        self._denominator_text = self._assemble_text(str(self.denominator))
+        self._vinculum_text = self._assemble_text('\u2015')
+
+    @classmethod
+    def ensure_pan_stl(cls, params: dict[str, int], directory: str) -> str:
+        """Render a pie pan to an STL file unless an identical one exists.
+
+        The file is named after a hash of the pan's OpenSCAD code and the
+        OpenSCAD options used to render it, so any change to the pan's
+        geometry gets a fresh STL. Returns the path of the STL file.
+        """
+        scad = cls(**params).pie_pan_scad()
+        flags = openscad_flags()
+        key = hashlib.sha256(json.dumps([scad, flags]).encode()).hexdigest()
+        pan_stl = os.path.join(directory, f'pie_pan_{key[:12]}.stl')
+        if not os.path.exists(pan_stl):
+            openscad(scad, pan_stl, 'binstl', flags)
+        return pan_stl
+
     def _assemble_text(self, string: str) -> text:
         return text(
             text=string,
             valign='center',
             halign='center',
-            size=self.label_font_size
+            size=ScadVariable('label_font_size')
         )
 
     def _assemble_label(self):
 
-        divide = self.slice_radius / 2
+        # The label refers to the variables declared by _label_variables,
+        # so any code rendered from a tree that includes it (that is, any
+        # pie slice) must be rendered with that header. Without it the
+        # sizes and positions come out undef.
         return union()(
             rotate(a=-90)(
-                linear_extrude(height=0.2 * self.slice_height)(
-                    translate(v=(0, divide / 2 + self.label_position,0))(
-                        rotate(a=180)(self._assemble_text(str(self.numerator)))
+                linear_extrude(height=ScadVariable('label_height'))(
+                    translate(v=(0, ScadVariable('numerator_y'),0))(
+                        rotate(a=180)(self._numerator_text)
                     ),
-                    translate(v=(0, divide - .05 * self.slice_radius + self.label_position,0))(
-                        scale(v=(self.label_divider_scale, 1, 1))(self._assemble_text('\u2015'))
+                    translate(v=(0, ScadVariable('vinculum_y'),0))(
+                        scale(v=(self.label_divider_scale, 1, 1))(self._vinculum_text)
                     ),
-                    translate(v=(0, divide + divide / 2 + self.label_position,0))(
-                        rotate(a=180)(self._assemble_text(str(self.denominator)))
+                    translate(v=(0, ScadVariable('denominator_y'),0))(
+                        rotate(a=180)(self._denominator_text)
                     )
                 )
             )
         ) # yapf: disable
 
 
+    def _assemble_profile(self):
+        return offset(r=self.fillet, segments=self.segments)(
+            square((self._profile_width, self._profile_height))
+        ) # yapf: disable
+
+
     def _assemble_slice(self):
+        if self.profile_file:
+            profile = import_(self.profile_file)
+        else:
+            profile = self._assemble_profile()
         return rotate_extrude(self._angle, segments=self.segments)(
-            translate((self.fillet, self.fillet, 0))(offset(r=self.fillet)(
-                square((self.slice_radius - 2 * self.fillet, self.slice_height - 2 * self.fillet)))
-            )
+            translate((self.fillet, self.fillet, 0))(profile)
         ) # yapf: disable
 
 
@@ -163,7 +352,7 @@ class FractionBlocks:
         outer = inner + self.pan_wall_width
         return difference()(
             cylinder(r=outer,
-                h=self.pan_floor_height + self.slice_height*0.8,
+                h=self._pan_height,
                 segments=self.segments),
             translate(v=(0, 0,self.pan_floor_height))(
                 cylinder(r=inner,h=self.slice_height,segments=self.segments)
@@ -171,30 +360,108 @@ class FractionBlocks:
         ) # yapf: disable
 
 
+    def _label_variables(self) -> str:
+        # The label's layout is declared once at the top of the file and
+        # referred to by name, rather than repeating literal numbers.
+        variables = {
+            'label_font_size': self.label_font_size,
+            'label_height': self._label_height,
+            'numerator_y': self._numerator_y,
+            'vinculum_y': self._vinculum_y,
+            'denominator_y': self._denominator_y,
+        }
+        return ''.join(
+            f'{name} = {py2openscad(value)};\n'
+            for name, value in variables.items()
+        )
+
+    def write_scad(self, scad: str) -> None:
+        """Write already generated OpenSCAD code to filename"""
+        # Build the whole file as one string and write it in one go
+        if self.include_code:
+            scad += sp_code_in_scad_comment(__file__)
+        Path(self.filename).write_text(scad, encoding='utf-8')
+
+    def profile_scad(self) -> str:
+        """Return OpenSCAD code for the cross section of the specified pie slice"""
+        return scad_render(self._assemble_profile())
+
+    def pie_slice_scad(self) -> str:
+        """Return OpenSCAD code for the specified pie slice"""
+        return scad_render(self._assemble_pie_slice(), self._label_variables())
+
+    def pie_pan_scad(self) -> str:
+        """Return OpenSCAD code for a pie pan that fits the specified pie slice"""
+        return scad_render(self._assemble_pie_pan())
+
+    def profile(self) -> None:
+        """Generate OpenSCAD code for the cross section of the specified pie slice"""
+        self.write_scad(self.profile_scad())
+
     def pie_slice(self) -> None:
         """Generate OpenSCAD code for the specified pie slice"""
-        scad_render_to_file(
-            self._assemble_pie_slice(), self.filename, include_orig_code=True
-        )
+        self.write_scad(self.pie_slice_scad())
 
     def pie_pan(self) -> None:
         """Generate OpenSCAD code for a pie pan that fits the specified pie slice"""
-        scad_render_to_file(
-            self._assemble_pie_pan(), self.filename, include_orig_code=True
+        self.write_scad(self.pie_pan_scad())
+
+    def pie_pan_fast(self) -> None:
+        """Generate an STL file for a pie pan that fits the specified pie slice
+        without going through OpenSCAD. The pan is only two cylinders, so
+        it's built directly with the optional manifold3d package, the same
+        geometry kernel OpenSCAD's Manifold backend uses. The STL is written
+        next to filename with an .stl extension.
+        """
+        import manifold3d  # pylint: disable=import-outside-toplevel
+
+        inner = self.slice_radius + self.slice_pan_gap
+        outer = inner + self.pan_wall_width
+        pan = manifold3d.Manifold.cylinder(
+            height=self._pan_height,
+            radius_low=outer,
+            circular_segments=self.segments
+        ) - manifold3d.Manifold.cylinder(
+            height=self.slice_height,
+            radius_low=inner,
+            circular_segments=self.segments
+        ).translate([0, 0, self.pan_floor_height])
+
+        mesh = pan.to_mesh()
+        write_binary_stl(
+            os.path.splitext(self.filename)[0] + '.stl',
+            mesh.vert_properties[:, :3], mesh.tri_verts
         )
 
     def test(self) -> None:
         """Generate OpenSCAD code for a test fit of the specified pie slice
         in a pie pan. This is provided to visualize the specified components.
         It should not be printed. It should only be rendered for testing.
+
+        When OpenSCAD is installed, the pie pan is rendered once to an STL
+        file next to filename and imported, so repeated test fits don't
+        rebuild it. If OpenSCAD is missing or the render fails, the pan is
+        built inline instead.
         """
-        test_assembly = self._assemble_pie_pan()
+        pan_params = {
+            name: getattr(self, name) for name in (
+                'slice_radius', 'slice_pan_gap', 'pan_wall_width',
+                'pan_floor_height', 'slice_height', 'segments'
+            )
+        }
+        try:
+            pan_stl = self.ensure_pan_stl(
+                pan_params, os.path.dirname(os.path.abspath(self.filename))
+            )
+        except (FileNotFoundError, subprocess.CalledProcessError):
+            test_assembly = self._assemble_pie_pan()
+        else:
+            # OpenSCAD resolves imports relative to the importing file
+            test_assembly = import_(os.path.basename(pan_stl))
         test_assembly += translate(v=(0, 0, self.pan_floor_height))(
             self._assemble_pie_slice()
         ) # yapf:disable
-        scad_render_to_file(
-            test_assembly, self.filename, include_orig_code=True
-        )
+        self.write_scad(scad_render(test_assembly, self._label_variables()))
 
 
 if __name__ == '__main__':
@@ -1,31 +1,194 @@
 #!/usr/bin/env python3
 
+import hashlib
+import importlib.util
+import json
 import os
+from concurrent.futures import ThreadPoolExecutor
+from math import gcd
 import fire
-from fraction_blocks import FractionBlocks
+from fraction_blocks import FractionBlocks, openscad, openscad_flags
 
 denominators: list[int] = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 12, 16]
 
+# Narrow slices need a smaller label to fit. Any denominator that isn't
+# listed here uses FractionBlocks' defaults.
+small_label: dict[str, int | float] = {
+    'label_font_size': 9,
+    'label_divider_scale': 0.7,
+    'label_position': 2
+}
+denominator_tweaks: dict[int, dict[str, int | float]] = {
+    9: small_label,
+    10: small_label,
+    12: small_label,
+    16: small_label,
+}
 
-def make_blocks(prefix: str = 'fb') -> None:
+# Every fraction in lowest terms for each denominator. Reducible
+# fractions like 2/4 would just be another 1/2 slice with a different
+# label, so they're left out.
+jobs: list[tuple[int, int]] = [
+    (numerator, denominator)
+    for denominator in denominators
+    for numerator in range(1, denominator + 1)
+    if gcd(numerator, denominator) == 1
+]
 
-    for denominator in denominators:
-        match denominator:
-            case 9|10|12|16:
-                block: FractionBlocks = FractionBlocks(denominator=denominator,
-                 label_font_size = 9, label_divider_scale = 0.7, label_position=2)
-            case _:
-                block: FractionBlocks = FractionBlocks(denominator=denominator)
 
-        filename_prefix: str = f'{prefix}_{block.numerator}_{block.denominator}'
-        block.filename=f'{filename_prefix}.scad'
+def source_hash(scad: str, imports: tuple[str, ...], flags: list[str]) -> str:
+    """Hash OpenSCAD code with the files it imports and the render options"""
+    # Imports are hashed by their contents. Their paths are cut down to
+    # the file name, so moving the output directory doesn't make every
+    # cached render look stale.
+    for filename in imports:
+        scad = scad.replace(filename, os.path.basename(filename))
+    digest = hashlib.sha256(scad.encode())
+    digest.update(json.dumps(flags).encode())
+    for filename in imports:
+        with open(filename, 'rb') as imported:
+            digest.update(imported.read())
+    return digest.hexdigest()
 
-        block.pie_slice()
-        os.system(f'openscad -o {filename_prefix}.stl --export-format binstl {filename_prefix}.scad --quiet')
 
-    FractionBlocks(filename=f'{prefix}_pie_pan.scad').pie_pan()
-    os.system(f'openscad -o {prefix}_pie_pan.stl --export-format binstl {prefix}_pie_pan.scad --quiet')
+def up_to_date(
+    scad: str, output: str, imports: tuple[str, ...], flags: list[str]
+) -> bool:
+    """Check whether an output was rendered from exactly this OpenSCAD code.
 
+    The .deps sidecar records a hash of the code the output was rendered
+    from, along with any files that code imports and the OpenSCAD options
+    it was rendered with. Any change to a block's parameters or to
+    fraction_blocks.py that affects the geometry changes the code and so
+    the hash, as does switching to an OpenSCAD with a different backend.
+    """
+    if not os.path.exists(output):
+        return False
+    try:
+        with open(f'{output}.deps', encoding='utf-8') as deps:
+            recorded = json.load(deps)['source']
+        return recorded == source_hash(scad, imports, flags)
+    except (OSError, ValueError, KeyError):
+        return False
+
+
+def pending_render(
+    block: FractionBlocks, part: str, output: str, flags: list[str],
+    keep_scad: bool
+) -> tuple[str, str, tuple[str, ...]] | None:
+    """Generate the OpenSCAD code for one part of a block.
+
+    Returns the code, the output file and the files the code imports, or
+    None when the output is already up to date.
+    """
+    scad = getattr(block, f'{part}_scad')()
+    if keep_scad:
+        block.write_scad(scad)
+    imports = (block.profile_file,) if block.profile_file else ()
+    if up_to_date(scad, output, imports, flags):
+        return None
+    return scad, output, imports
+
+
+def render(
+    job: tuple[str, str, tuple[str, ...]],
+    *,
+    flags: list[str],
+    env: dict[str, str],
+    export_format: str = 'binstl'
+) -> None:
+    """Render a job from pending_render and record its .deps hash"""
+    scad, output, imports = job
+    openscad(scad, output, export_format, flags, env)
+    with open(f'{output}.deps', 'w', encoding='utf-8') as deps:
+        json.dump({'source': source_hash(scad, imports, flags)}, deps)
+
+
+def render_profile(
+    prefix: str, flags: list[str], env: dict[str, str], keep_scad: bool
+) -> str:
+    """Render the cross section shared by every pie slice to a .dxf file"""
+    # The slices import the profile by absolute path. Code piped to
+    # OpenSCAD on stdin resolves relative imports against the working
+    # directory, while a .scad kept with --keep_scad resolves them
+    # against its own directory. These differ whenever the prefix
+    # includes a directory, and an absolute path works for both.
+    profile_file = os.path.abspath(f'{prefix}_profile.dxf')
+    block = FractionBlocks(
+        filename=f'{prefix}_profile.scad', include_code=False
+    )
+    pending = pending_render(block, 'profile', profile_file, flags, keep_scad)
+    if pending:
+        render(pending, flags=flags, env=env, export_format='dxf')
+    return profile_file
+
+
+def slice_block(
+    numerator: int, denominator: int, prefix: str, profile_file: str
+) -> FractionBlocks:
+    """Set up the pie slice for one fraction"""
+    return FractionBlocks(
+        filename=f'{prefix}_{numerator}_{denominator}.scad',
+        numerator=numerator,
+        denominator=denominator,
+        include_code=False,
+        profile_file=profile_file,
+        **denominator_tweaks.get(denominator, {})
+    )
+
+
+def make_blocks(
+    prefix: str = 'fb',
+    cache_dir: str = '.openscad_cache',
+    keep_scad: bool = False,
+    unit_fractions: bool = False
+) -> None:
+
+    # Point every OpenSCAD process at the same cache directory so the
+    # font cache built by the first render is reused by all the others.
+    env = {**os.environ, 'XDG_CACHE_HOME': os.path.abspath(cache_dir)}
+    flags = openscad_flags()
+    profile_file = render_profile(prefix, flags, env, keep_scad)
+
+    parts: list[tuple[FractionBlocks, str, str]] = [
+        (
+            slice_block(numerator, denominator, prefix, profile_file),
+            'pie_slice', f'{prefix}_{numerator}_{denominator}.stl'
+        )
+        for numerator, denominator in jobs
+        if numerator == 1 or not unit_fractions
+    ]
+
+    pan = FractionBlocks(filename=f'{prefix}_pie_pan.scad', include_code=False)
+    if importlib.util.find_spec('manifold3d') is None:
+        parts.append((pan, 'pie_pan', f'{prefix}_pie_pan.stl'))
+    else:
+        # The pan is simple enough to build in Python when manifold3d is
+        # installed, which takes milliseconds instead of an OpenSCAD run.
+        if keep_scad:
+            pan.pie_pan()
+        pan.pie_pan_fast()
+
+    # Generate all of the OpenSCAD code in one pass up front, so the
+    # workers only have to hand finished code to OpenSCAD.
+    pending = [
+        pending_render(block, part, output, flags, keep_scad)
+        for block, part, output in parts
+    ]
+
+    # Each block is independent, so run one OpenSCAD per block and let
+    # them render side by side rather than waiting on each in turn. The
+    # real work happens in the OpenSCAD processes, so threads that just
+    # wait on them are enough.
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = [
+            executor.submit(render, job, flags=flags, env=env)
+            for job in pending
+            if job
+        ]
+
+    for future in futures:
+        future.result()
 
 
 if __name__ == "__main__":